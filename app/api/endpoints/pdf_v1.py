@@ -6,27 +6,67 @@ This module defines the router for handling PDF-related operations. It includes
     - Deleting temporary files.
 """
 
-import json
+import asyncio
+import contextlib
+import logging
 import os
-from uuid import uuid4
-from datetime import datetime, timedelta
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Literal
 from fastapi import APIRouter, UploadFile, File, status, HTTPException, Form
+from fastapi.concurrency import run_in_threadpool
+
+try:
+    from orjson import loads as json_loads
+except ImportError:  # orjson is optional
+    from json import loads as json_loads
 
 from app.core.config import settings
-from app.services.pdf_service_v1 import PDFService
+from app.services import pdf_cache
+from app.services.pdf_service_v1 import IMAGE_SAVE_OPTIONS, PDFService
 from app.schemas.pdf_v1 import FiguresResponse
 
 
+logger = logging.getLogger(__name__)
+
 router = APIRouter(prefix='/pdf', tags=['pdf'])
 
+# fail at startup rather than on every request
+if settings.IMAGE_FORMAT not in IMAGE_SAVE_OPTIONS:
+    raise ValueError(
+        f"Invalid IMAGE_FORMAT '{settings.IMAGE_FORMAT}', expected one of: {', '.join(IMAGE_SAVE_OPTIONS)}."
+    )
+if not 0 <= settings.PNG_COMPRESS_LEVEL <= 9:
+    raise ValueError(f"Invalid PNG_COMPRESS_LEVEL {settings.PNG_COMPRESS_LEVEL}, expected 0-9.")
+
+PDF_MAGIC = b'%PDF-'
+
+# random temp file name prefixes, generated in batches to amortize the os.urandom call
+PREFIX_BATCH_SIZE = 1024
+_prefix_pool: deque[str] = deque()
+
+# shortest interval between two sweeps of `sweep_tempfiles`, in seconds
+MIN_SWEEP_INTERVAL = 60
+
+# last result of `list_tempfiles`: (listing time, directory, file paths)
+_tempfiles_listing: tuple[float, str, list[str]] | None = None
+
+# encodes and writes images to disk while the next page is being rendered
+SAVE_POOL_SIZE = 4
+save_pool = ThreadPoolExecutor(max_workers=SAVE_POOL_SIZE)
+# images of a request waiting to be saved, beyond which rendering waits for the oldest save
+MAX_PENDING_SAVES = 2 * SAVE_POOL_SIZE
+
 
 @router.post('/images', response_model=list[str])
-async def pdf_to_images(file: UploadFile = File(...)):
+async def pdf_to_images(file: UploadFile = File(...), fmt: Literal['png', 'jpeg', 'webp'] | None = None):
     """
     Convert a PDF file to images, one image per page.
 
     Args:
         file (UploadFile): The uploaded PDF file.
+        fmt (Literal['png', 'jpeg', 'webp'] | None): The output image format. Defaults to settings.IMAGE_FORMAT.
 
     Returns:
         list[str]: List of paths to the generated images.
@@ -34,24 +74,16 @@ async def pdf_to_images(file: UploadFile = File(...)):
     Raises:
         HTTPException: If the file type is invalid or conversion fails.
     """
-    if file.content_type != 'application/pdf':
+    if not await is_pdf_upload(file):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail='Invalid file type. Only PDF file allowed.'
         )
 
+    fmt = fmt or settings.IMAGE_FORMAT
     try:
-        pdfbytes = await file.read()
-        pdf_service = PDFService(pdfbytes)
-
-        random_str = uuid4().hex
-        urls = []
-        for i, image in enumerate(pdf_service.doc_to_images_gen()):
-            imagepath = f'{settings.TEMPFILE_ROOT_DIR}/{random_str}-page{i}.png'
-            image.save(imagepath)
-            urls.append(imagepath)
-
-        return urls
+        pdfbytes, digest = await read_upload(file)
+        return await run_in_threadpool(process_pdf_images, pdfbytes, digest, fmt)
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -66,18 +98,21 @@ async def extract_figures(
     figure_bboxes: str = Form(...),
     del_page_start: int | None = Form(None),
     del_page_end: int | None = Form(None),
-    del_pages_list: str | None = Form(None)
+    del_pages_list: str | None = Form(None),
+    fmt: Literal['png', 'jpeg', 'webp'] | None = None
 ):
     """
     Extract figures and captions from a PDF file and redact specified areas.
 
     Args:
         file (UploadFile): The uploaded PDF file.
-        redaction_bboxes (str): JSON string of bounding boxes to redact.
-        figure_bboxes (str): JSON string of bounding boxes for figures.
+        redaction_bboxes (str): JSON string of bounding boxes to redact, see parse_page_bboxes.
+        figure_bboxes (str): JSON string of bounding boxes for figures, see parse_page_bboxes.
         del_page_start (int | None): Start of page range to delete (optional).
         del_page_end (int | None): End of page range to delete (optional).
         del_pages_list (str | None): JSON string of specific pages to delete (optional).
+        fmt (Literal['png', 'jpeg', 'webp'] | None): The output image format for figures and captions.
+            Defaults to settings.IMAGE_FORMAT.
 
     Returns:
         FiguresResponse: A response object containing the updated PDF file path and extracted figures.
@@ -85,43 +120,31 @@ async def extract_figures(
     Raises:
         HTTPException: If the file type is invalid or figure extraction fails.
     """
-    if file.content_type != 'application/pdf':
+    if not await is_pdf_upload(file):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail='Invalid file type. Only PDF file allowed.'
         )
 
+    fmt = fmt or settings.IMAGE_FORMAT
     try:
-        parsed_redaction_bboxes = json.loads(redaction_bboxes)
-        parsed_redaction_bboxes = {int(k): v for k, v in parsed_redaction_bboxes.items()}
-
-        parsed_figure_bboxes = json.loads(figure_bboxes)
-        parsed_figure_bboxes = {int(k): v for k, v in parsed_figure_bboxes.items()}
-
-        pdfbytes = await file.read()
-        pdf_service = PDFService(pdfbytes)
-
-        random_str = uuid4().hex
-        extracted_figures = pdf_service.extract_figures(parsed_figure_bboxes)
-        for k, v in extracted_figures.items():
-            for idx, pair in enumerate(v):
-                figure_path = f'{settings.TEMPFILE_ROOT_DIR}/{random_str}-page{k}-figure{idx}.png'
-                pair[0].save(figure_path)
-                pair[0] = figure_path
-                if pair[1]:
-                    caption_path = f'{settings.TEMPFILE_ROOT_DIR}/{random_str}-page{k}-caption{idx}.png'
-                    pair[1].save(caption_path)
-                    pair[1] = caption_path
-
-        pdf_service.redact_doc(parsed_redaction_bboxes, parsed_figure_bboxes)
-
-        del_pages = json.loads(del_pages_list) if del_pages_list else None
-        pdf_service.delete_pages(del_page_start, del_page_end, del_pages)
-
-        docpath = f'{settings.TEMPFILE_ROOT_DIR}/{random_str}.pdf'
-        pdf_service.save(docpath)
-
-        return FiguresResponse(doc=docpath, figures=extracted_figures)
+        parsed_redaction_bboxes = parse_page_bboxes(redaction_bboxes)
+        parsed_figure_bboxes = parse_page_bboxes(figure_bboxes)
+
+        del_pages = json_loads(del_pages_list) if del_pages_list else None
+
+        pdfbytes, digest = await read_upload(file)
+        return await run_in_threadpool(
+            process_pdf_figures,
+            pdfbytes,
+            digest,
+            parsed_redaction_bboxes,
+            parsed_figure_bboxes,
+            del_page_start,
+            del_page_end,
+            del_pages,
+            fmt,
+        )
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -141,7 +164,7 @@ async def get_tempfiles():
         HTTPException: If listing files fails.
     """
     try:
-        return list_tempfiles()
+        return await asyncio.to_thread(list_tempfiles, use_cache=True)
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
                             detail="Failed to list temp files.")
@@ -150,33 +173,235 @@ async def get_tempfiles():
 @router.delete('/tempfiles', status_code=status.HTTP_204_NO_CONTENT)
 async def delete_tempfiles():
     """
-    Delete all temporary files older than the retention time.
+    Delete all temporary files older than the retention time, and drop cached PDF documents.
 
     Raises:
         HTTPException: If deletion fails.
     """
     try:
-        for f in list_tempfiles():
-            os.remove(f)
+        await cleanup_tempfiles()
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
                             detail="Failed to delete temp files.")
 
 
-def list_tempfiles():
+def process_pdf_images(pdfbytes: bytes, digest: bytes, fmt: str) -> list[str]:
+    """
+    Convert a PDF file to images, one image per page. Blocking, run it off the event loop.
+
+    Args:
+        pdfbytes (bytes): The PDF file data in bytes.
+        digest (bytes): The content digest of pdfbytes.
+        fmt (str): The output image format.
+
+    Returns:
+        list[str]: List of paths to the generated images.
+    """
+    prefix = f'{settings.TEMPFILE_ROOT_DIR}/{random_prefix()}'
+    urls = []
+    pending = deque()
+    pdf_service = PDFService(pdfbytes, digest=digest)
+    for i, image in enumerate(pdf_service.doc_to_images_gen()):
+        imagepath = f'{prefix}-page{i}.{fmt}'
+        pending.append(save_pool.submit(PDFService.save_image, image, imagepath, fmt))
+        urls.append(imagepath)
+        if len(pending) > MAX_PENDING_SAVES:
+            # saving falls behind rendering, wait instead of piling up page images in memory
+            pending.popleft().result()
+
+    for future in pending:
+        future.result()  # wait for all saves, re-raising any error
+
+    return urls
+
+
+def process_pdf_figures(
+    pdfbytes: bytes,
+    digest: bytes,
+    redaction_bboxes: dict[int, list],
+    figure_bboxes: dict[int, list],
+    del_page_start: int | None,
+    del_page_end: int | None,
+    del_pages_list: list[int] | None,
+    fmt: str,
+) -> FiguresResponse:
+    """
+    Extract figures and captions from a PDF file and redact specified areas. Blocking, run it off the event loop.
+
+    Args:
+        pdfbytes (bytes): The PDF file data in bytes.
+        digest (bytes): The content digest of pdfbytes.
+        redaction_bboxes (dict[int, list]): Bounding boxes to redact per page.
+        figure_bboxes (dict[int, list]): Bounding boxes for figures and captions per page.
+        del_page_start (int | None): Start of page range to delete.
+        del_page_end (int | None): End of page range to delete.
+        del_pages_list (list[int] | None): Specific pages to delete.
+        fmt (str): The output image format for figures and captions.
+
+    Returns:
+        FiguresResponse: A response object containing the updated PDF file path and extracted figures.
+    """
+    pdf_service = PDFService(pdfbytes, digest=digest)
+
+    prefix = f'{settings.TEMPFILE_ROOT_DIR}/{random_prefix()}'
+    extracted_figures = pdf_service.extract_figures(figure_bboxes)
+    for k, v in extracted_figures.items():
+        for idx, pair in enumerate(v):
+            figure_path = f'{prefix}-page{k}-figure{idx}.{fmt}'
+            PDFService.save_image(pair[0], figure_path, fmt)
+            pair[0] = figure_path
+            if pair[1]:
+                caption_path = f'{prefix}-page{k}-caption{idx}.{fmt}'
+                PDFService.save_image(pair[1], caption_path, fmt)
+                pair[1] = caption_path
+
+    pdf_service.redact_doc(redaction_bboxes, figure_bboxes)
+    pdf_service.delete_pages(del_page_start, del_page_end, del_pages_list)
+
+    docpath = f'{prefix}.pdf'
+    pdf_service.save(docpath)
+
+    return FiguresResponse(doc=docpath, figures=extracted_figures)
+
+
+def random_prefix() -> str:
+    """
+    Get a random prefix for temp file names.
+
+    Returns:
+        str: 32 hex characters, i.e. 128 random bits.
+    """
+    try:
+        return _prefix_pool.popleft()
+    except IndexError:
+        # deque operations are thread-safe, concurrent refills only add extra prefixes
+        randbytes = os.urandom(16 * PREFIX_BATCH_SIZE)
+        _prefix_pool.extend(randbytes[i:i + 16].hex() for i in range(16, len(randbytes), 16))
+        return randbytes[:16].hex()
+
+
+def parse_page_bboxes(data: str) -> dict[int, list]:
+    """
+    Parse a JSON string of bounding boxes per page.
+
+    Two layouts are accepted: an object keyed by page number, e.g. `{"0": [...]}`,
+    or an array of `[page, bboxes]` pairs, e.g. `[[0, [...]]]`.
+
+    Args:
+        data (str): The JSON string.
+
+    Returns:
+        dict[int, list]: Bounding boxes keyed by page number.
+    """
+    parsed = json_loads(data)
+    pairs = parsed if isinstance(parsed, list) else parsed.items()
+    return {int(k): v for k, v in pairs}
+
+
+async def is_pdf_upload(file: UploadFile) -> bool:
+    """
+    Check that an uploaded file is a PDF by its magic bytes, regardless of the content type sent by the client.
+
+    Args:
+        file (UploadFile): The uploaded file.
+
+    Returns:
+        bool: True if the file starts with the PDF header, False otherwise.
+    """
+    head = await file.read(len(PDF_MAGIC))
+    await file.seek(0)
+    return head == PDF_MAGIC
+
+
+async def read_upload(file: UploadFile) -> tuple[bytes, bytes]:
+    """
+    Read an uploaded file and compute its content digest.
+
+    The file is read in a single call, so only one copy of the data is held in memory.
+
+    Args:
+        file (UploadFile): The uploaded file.
+
+    Returns:
+        tuple[bytes, bytes]: The file data and its content digest.
+    """
+    pdfbytes = await file.read()
+    # hashlib releases the GIL on large inputs, hash on the threadpool to keep the event loop free
+    return pdfbytes, await run_in_threadpool(pdf_cache.content_digest, pdfbytes)
+
+
+async def remove_files(file_paths: list[str], max_concurrency: int = 32):
+    """
+    Remove files concurrently on worker threads, without blocking the event loop.
+
+    Files that no longer exist are skipped, e.g. when the sweeper and DELETE /tempfiles remove the same files.
+
+    Args:
+        file_paths (list[str]): Paths to the files to remove.
+        max_concurrency (int, optional): Maximum number of files removed at the same time. Defaults to 32.
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def remove(file_path):
+        async with semaphore:
+            with contextlib.suppress(FileNotFoundError):
+                await asyncio.to_thread(os.remove, file_path)
+
+    await asyncio.gather(*(remove(f) for f in file_paths))
+
+
+async def cleanup_tempfiles():
+    """
+    Delete all temporary files older than the retention time, and drop cached PDF documents.
+    """
+    global _tempfiles_listing
+
+    await remove_files(await asyncio.to_thread(list_tempfiles))
+    _tempfiles_listing = None
+    pdf_cache.clear()
+
+
+async def sweep_tempfiles():
+    """
+    Background task that runs `cleanup_tempfiles` every half retention time, but at most once
+    per MIN_SWEEP_INTERVAL, until cancelled.
+    """
+    while True:
+        await asyncio.sleep(max(settings.FILE_RETENTION_TIME / 2, MIN_SWEEP_INTERVAL))
+        try:
+            await cleanup_tempfiles()
+        except Exception:
+            logger.exception('Failed to sweep temp files.')
+
+
+def list_tempfiles(use_cache: bool = False):
     """
     List temporary files that exceed the retention time.
 
+    Args:
+        use_cache (bool, optional): Reuse a listing made less than a quarter retention time ago. Defaults to False.
+
     Returns:
         list[str]: Paths to temporary files.
     """
-    curr_time = datetime.now()
-    cutoff_time = curr_time - timedelta(seconds=settings.FILE_RETENTION_TIME)
+    global _tempfiles_listing
+
+    now = time.time()
+    root_dir = settings.TEMPFILE_ROOT_DIR
+    if use_cache and _tempfiles_listing is not None:
+        listed_at, listed_dir, file_paths = _tempfiles_listing
+        if listed_dir == root_dir and now - listed_at < settings.FILE_RETENTION_TIME / 4:
+            return file_paths
+
+    cutoff_time = now - settings.FILE_RETENTION_TIME
 
+    # DirEntry provides the full path and the mtime is compared as a float, saving os.path.join and
+    # datetime.fromtimestamp per file; on POSIX entry.stat() is still one stat call per file
     file_paths = []
-    for file_name in os.listdir(settings.TEMPFILE_ROOT_DIR):
-        file_path = os.path.join(settings.TEMPFILE_ROOT_DIR, file_name)
-        file_modified_time = datetime.fromtimestamp(os.path.getmtime(file_path))
-        if file_modified_time < cutoff_time:
-            file_paths.append(file_path)
+    with os.scandir(root_dir) as entries:
+        for entry in entries:
+            with contextlib.suppress(FileNotFoundError):  # removed by a concurrent cleanup
+                if entry.stat().st_mtime < cutoff_time:
+                    file_paths.append(entry.path)
+    _tempfiles_listing = (now, root_dir, file_paths)
     return file_paths
@@ -8,6 +8,9 @@ PROJECT_VERSION: str = os.getenv('PROJECT_VERSION', '')
 FILE_RETENTION_TIME: int = int(os.getenv('FILE_RETENTION_TIME', 3600))  # seconds
 TEMPFILE_ROOT_DIR: str = os.getenv('TEMPFILE_ROOT_DIR', 'static')
 CORS_ORIGINS: str = os.getenv('CORS_ORIGINS', '')
+IMAGE_FORMAT: str = os.getenv('IMAGE_FORMAT', 'png').lower()  # png, jpeg or webp
+PNG_COMPRESS_LEVEL: int = int(os.getenv('PNG_COMPRESS_LEVEL', 1))  # zlib level 0-9
+THREADPOOL_SIZE: int = int(os.getenv('THREADPOOL_SIZE', 64))
 
 
 class Settings:
@@ -16,6 +19,9 @@ class Settings:
     FILE_RETENTION_TIME: int = FILE_RETENTION_TIME
     TEMPFILE_ROOT_DIR: str = TEMPFILE_ROOT_DIR
     CORS_ORIGINS: str = CORS_ORIGINS
+    IMAGE_FORMAT: str = IMAGE_FORMAT
+    PNG_COMPRESS_LEVEL: int = PNG_COMPRESS_LEVEL
+    THREADPOOL_SIZE: int = THREADPOOL_SIZE
 
 
 settings = Settings()
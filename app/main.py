@@ -1,4 +1,8 @@
+import asyncio
 import os
+from contextlib import asynccontextmanager
+
+import anyio
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
@@ -7,10 +11,26 @@ from app.api.endpoints import heartbeat, pdf_v1
 from app.core.config import settings
 
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # PDF processing runs on the threadpool, allow more concurrent requests than the default 40
+    anyio.to_thread.current_default_thread_limiter().total_tokens = settings.THREADPOOL_SIZE
+
+    # delete expired temp files periodically instead of relying on clients to call DELETE /tempfiles
+    sweeper = asyncio.create_task(pdf_v1.sweep_tempfiles())
+    yield
+    sweeper.cancel()
+    try:
+        await sweeper
+    except asyncio.CancelledError:
+        pass
+
+
 app = FastAPI(
     title=settings.PROJECT_NAME,
     version=settings.PROJECT_VERSION,
     description="A REST API service for processing PDF files.",
+    lifespan=lifespan,
 )
 
 # Configure CORS
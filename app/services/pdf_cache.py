@@ -0,0 +1,145 @@
+"""
+This module caches parsed PDF documents keyed by a hash of their content, so that consecutive requests
+on the same upload (e.g. /pdf/images followed by /pdf/figures) reuse the already parsed Document
+instead of parsing the PDF again.
+
+Cached documents are shared and must be treated as read-only; callers that modify a document
+have to work on their own copy (see PDFService). PyMuPDF does not support using a Document from
+several threads at once, so loading and rendering pages of a shared document must be done while
+holding its `document_lock`. Documents are closed as soon as they are evicted
+and no longer in use, so MuPDF memory is freed without waiting for garbage collection.
+"""
+
+import hashlib
+import threading
+from collections import OrderedDict
+
+import pymupdf
+from pymupdf import Document
+
+
+MAX_CACHED_DOCS = 16
+
+_docs: OrderedDict[bytes, Document] = OrderedDict()
+_borrows: dict[int, int] = {}  # id(doc) -> number of callers currently using the doc
+_evicted: dict[int, Document] = {}  # evicted docs that are still in use
+_doc_locks: dict[int, threading.Lock] = {}  # id(doc) -> lock serializing the use of the doc
+_lock = threading.Lock()
+
+
+def content_digest(pdfbytes: bytes) -> bytes:
+    """
+    Compute the cache key of PDF data.
+
+    Args:
+        pdfbytes (bytes): The PDF file data in bytes.
+
+    Returns:
+        bytes: A 16-byte BLAKE2b digest of the data.
+    """
+    return hashlib.blake2b(pdfbytes, digest_size=16).digest()
+
+
+def acquire_document(pdfbytes: bytes, digest: bytes | None = None) -> Document:
+    """
+    Get the parsed Document for PDF data, parsing and caching it on a miss.
+
+    Every call must be paired with a `release_document` call once the caller is done with the document.
+
+    Args:
+        pdfbytes (bytes): The PDF file data in bytes.
+        digest (bytes | None, optional): The precomputed content digest of the data. Defaults to None.
+
+    Returns:
+        Document: The shared, read-only Document object.
+    """
+    if digest is None:
+        digest = content_digest(pdfbytes)
+
+    with _lock:
+        doc = _docs.get(digest)
+        if doc is not None:
+            _docs.move_to_end(digest)
+            _borrows[id(doc)] += 1
+            return doc
+
+    doc = pymupdf.open('pdf', pdfbytes)
+    with _lock:
+        cached = _docs.get(digest)
+        if cached is not None:
+            # parsed by another thread in the meantime
+            doc.close()
+            doc = cached
+            _docs.move_to_end(digest)
+        else:
+            _docs[digest] = doc
+            _borrows[id(doc)] = 0
+            _doc_locks[id(doc)] = threading.Lock()
+            while len(_docs) > MAX_CACHED_DOCS:
+                _, evicted = _docs.popitem(last=False)
+                _evict(evicted)
+        _borrows[id(doc)] += 1
+    return doc
+
+
+def document_lock(doc: Document) -> threading.Lock:
+    """
+    Get the lock to hold while using a document obtained from `acquire_document`, e.g. loading or rendering pages.
+
+    Args:
+        doc (Document): The acquired document.
+
+    Returns:
+        threading.Lock: The lock of the document.
+    """
+    with _lock:
+        return _doc_locks[id(doc)]
+
+
+def release_document(doc: Document):
+    """
+    Release a document obtained from `acquire_document`.
+
+    Args:
+        doc (Document): The document to release.
+    """
+    with _lock:
+        _borrows[id(doc)] -= 1
+        if not _borrows[id(doc)] and id(doc) in _evicted:
+            _close(doc)
+
+
+def clear():
+    """
+    Drop all cached documents.
+    """
+    with _lock:
+        for doc in _docs.values():
+            _evict(doc)
+        _docs.clear()
+
+
+def _evict(doc: Document):
+    """
+    Close an evicted document, or defer closing it until its last borrower releases it. Call with `_lock` held.
+
+    Args:
+        doc (Document): The evicted document.
+    """
+    if _borrows[id(doc)]:
+        _evicted[id(doc)] = doc
+    else:
+        _close(doc)
+
+
+def _close(doc: Document):
+    """
+    Close a document to free its MuPDF memory right away. Call with `_lock` held.
+
+    Args:
+        doc (Document): The document to close.
+    """
+    del _borrows[id(doc)]
+    del _doc_locks[id(doc)]
+    _evicted.pop(id(doc), None)
+    doc.close()
@@ -1,7 +1,178 @@
-import numpy as np
+import functools
+import math
+import multiprocessing
+import os
+import threading
+import weakref
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import compress, islice
+
 import pymupdf
 from pymupdf import Document, Page
-from PIL import Image, ImageOps
+from PIL import Image
+
+from app.core.config import settings
+from app.services import pdf_cache
+
+
+# bound once at module level, saving the attribute lookup in per-page and per-bbox loops
+_open = pymupdf.open
+_Rect = pymupdf.Rect
+
+# Pillow save options per output image format; generated images are short-lived temp files,
+# so fast encoding is preferred over the smallest file size. PNG level 1 encodes several times faster
+# than Pillow's default 6 for slightly larger files
+IMAGE_SAVE_OPTIONS = {
+    'png': {'format': 'PNG', 'compress_level': settings.PNG_COMPRESS_LEVEL, 'optimize': False},
+    'jpeg': {'format': 'JPEG', 'quality': 85},
+    'webp': {'format': 'WEBP', 'lossless': True, 'quality': 0, 'method': 0},
+}
+
+# pymupdf options for writing a compacted PDF
+PDF_SAVE_OPTIONS = {'garbage': 3, 'deflate': True, 'use_objstms': 1}
+# deleting pages creates no new objects, so dropping the unreferenced ones is enough
+# and the costly duplicate-object merging of garbage=3 can be skipped
+PAGE_DELETION_SAVE_OPTIONS = {'garbage': 1, 'deflate': True, 'use_objstms': 1}
+
+
+@functools.cache
+def _default_workers() -> int:
+    """
+    Get the default number of render worker processes.
+
+    Follows the CPUs this process may actually use, i.e. its CPU affinity and the cgroup v2 CPU quota
+    of its container, rather than the number of CPUs of the host, so that throttled containers are not
+    oversubscribed. Pass `num_workers` explicitly to override.
+
+    Returns:
+        int: The number of usable CPUs, at most 4.
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        cpus = len(os.sched_getaffinity(0))
+    else:
+        cpus = os.cpu_count() or 1
+
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            quota, period = f.read().split()
+        if quota != 'max':
+            # round up, a 1.5 CPU quota keeps 2 workers busy most of the time
+            cpus = min(cpus, math.ceil(int(quota) / int(period)))
+    except (OSError, ValueError):
+        pass  # no cgroup v2 CPU limit
+
+    return min(cpus, 4)
+
+
+def _rgb_pixmap(page: Page, DPI: int, clip: pymupdf.Rect | None = None) -> pymupdf.Pixmap:
+    """
+    Render a PDF page, or a region of it, to a 3-byte-per-pixel RGB pixmap without alpha channel.
+
+    Args:
+        page (Page): The PDF page to render.
+        DPI (int): The dots per inch (resolution) for rendering.
+        clip (pymupdf.Rect | None, optional): The region to render, in PDF points. Defaults to the full page.
+
+    Returns:
+        pymupdf.Pixmap: The rendered pixmap.
+    """
+    return page.get_pixmap(dpi=DPI, clip=clip, colorspace=pymupdf.csRGB, alpha=False)
+
+
+def _rgb_image(samples, w: int, h: int, stride: int) -> Image.Image:
+    """
+    Build an image from the samples of an RGB pixmap.
+
+    Args:
+        samples: The pixel data, `pixmap.samples` or `pixmap.samples_mv`.
+        w (int): The width of the pixmap.
+        h (int): The height of the pixmap.
+        stride (int): The number of bytes per row, which may include padding.
+
+    Returns:
+        Image.Image: The image.
+    """
+    # samples_mv is a view on the pixmap memory, so the only copy is the one into Pillow's storage.
+    # Image.frombuffer cannot avoid that copy: Pillow stores RGB as 4 bytes per pixel and only
+    # shares buffers for modes like L/RGBA/RGBX, falling back to frombytes for RGB.
+    return Image.frombytes('RGB', (w, h), samples, 'raw', 'RGB', stride)
+
+
+# document opened once per worker process by `_init_render_worker`
+_worker_doc: Document | None = None
+
+
+def _init_render_worker(pdfbytes: bytes):
+    """
+    Open the PDF document once in a render worker process.
+
+    Args:
+        pdfbytes (bytes): The PDF file data in bytes.
+    """
+    global _worker_doc
+    _worker_doc = _open('pdf', pdfbytes)
+
+
+def _render_page(page_index: int, DPI: int) -> tuple[int, bytes, int, int, int]:
+    """
+    Render a single page in a render worker process.
+
+    Raw pixel data is returned instead of an Image, which keeps pickling back to the parent process cheap.
+
+    Args:
+        page_index (int): The index of the page to render.
+        DPI (int): The dots per inch (resolution) for rendering.
+
+    Returns:
+        tuple[int, bytes, int, int, int]: The page index, the RGB samples, the width, the height and the stride
+            of the pixmap.
+    """
+    pixmap = _rgb_pixmap(_worker_doc[page_index], DPI)
+    return page_index, pixmap.samples, pixmap.w, pixmap.h, pixmap.stride
+
+
+# documents with fewer pages are rendered in place, where starting worker processes that each parse
+# the document again costs more than it saves
+MIN_PARALLEL_PAGES = 8
+
+# render workers must not be forked from the server process, whose event loop and threadpool threads
+# may hold locks at the time of the fork; forkserver forks them from a clean single-threaded process
+if 'forkserver' in multiprocessing.get_all_start_methods():
+    _mp_context = multiprocessing.get_context('forkserver')
+    _mp_context.set_forkserver_preload([__name__])
+else:
+    _mp_context = multiprocessing.get_context('spawn')
+
+# render worker processes of all concurrent requests together, so that they do not oversubscribe the CPUs
+_render_slots = threading.BoundedSemaphore(_default_workers())
+
+
+def _acquire_render_slots(n: int) -> int:
+    """
+    Take up to n render worker slots, without waiting for slots held by other requests.
+
+    Args:
+        n (int): The number of worker processes wanted.
+
+    Returns:
+        int: The number of slots taken, to be given back with `_release_render_slots`.
+    """
+    taken = 0
+    while taken < n and _render_slots.acquire(blocking=False):
+        taken += 1
+    return taken
+
+
+def _release_render_slots(n: int):
+    """
+    Give back render worker slots taken with `_acquire_render_slots`.
+
+    Args:
+        n (int): The number of slots to give back.
+    """
+    for _ in range(n):
+        _render_slots.release()
 
 
 class PDFService:
@@ -10,26 +181,127 @@ class PDFService:
     extracting figures, redacting content, deleting pages, and reducing PDF file size.
     """
 
-    def __init__(self, pdfbytes: bytes, DPI: int = 96):
+    def __init__(
+            self,
+            pdfbytes: bytes,
+            DPI: int = 96,
+            digest: bytes | None = None,
+    ):
         """
         Initialize the PDFService with PDF data in bytes format and an optional DPI value.
 
         Args:
             pdfbytes (bytes): The PDF file data in bytes.
             DPI (int, optional): The dots per inch (resolution) for image conversion from a PDF page. Defaults to 96.
+            digest (bytes | None, optional): The precomputed content digest of pdfbytes. Defaults to None.
         """
-        self.doc = PDFService.bytes_to_doc(pdfbytes)
+        self._pdfbytes = pdfbytes
+        self._digest = digest
+        # shared with other requests through the cache until the first modification
+        self.doc = pdf_cache.acquire_document(pdfbytes, digest)
+        self._release_shared_doc = weakref.finalize(self, pdf_cache.release_document, self.doc)
+        # held while loading or rendering pages of self.doc, which other threads may be using as well
+        self._doc_lock = pdf_cache.document_lock(self.doc)
         self.DPI = DPI
-
-    def doc_to_images_gen(self):
+        # pymupdf uses DPI 72 for page coordinates
+        self._points_per_pixel = 72 / DPI
+        # PDF data matching the current state of self.doc, None from a modification until the next compaction
+        self._docbytes = pdfbytes
+        # whether content was redacted, as opposed to only pages being deleted
+        self._redacted = False
+
+    def doc_to_images_gen(self, num_workers: int | None = None, DPI: int | None = None):
         """
         Generator that converts each page of the PDF document to an image.
 
+        Pages are rendered in parallel processes when PDF data matching the document is at hand,
+        i.e. the document is unmodified or was compacted after its last modification; otherwise in place.
+        Images are rendered at the requested resolution, callers should not resize them.
+
+        Args:
+            num_workers (int | None, optional): The maximum number of worker processes. Defaults to the number
+                of CPUs available to this process, at most 4.
+            DPI (int | None, optional): The resolution for this call only. Defaults to self.DPI.
+
         Yields:
             Image: An image of a PDF page.
         """
-        for page in self.doc:
-            yield self.page_to_image(page)
+        DPI = DPI or self.DPI
+        if self._docbytes is not None:  # unmodified, or compacted since the last modification
+            digest = self._digest if self._docbytes is self._pdfbytes else None
+            yield from PDFService.doc_to_images_parallel(self._docbytes, DPI, num_workers, digest)
+        else:
+            for page in self.doc:
+                yield self.page_to_image(page, DPI)
+
+    @staticmethod
+    def doc_to_images_parallel(
+            pdfbytes: bytes,
+            DPI: int = 96,
+            num_workers: int | None = None,
+            digest: bytes | None = None,
+    ):
+        """
+        Generator that converts each page of a PDF document to an image, rendering pages in parallel processes.
+
+        The worker processes of all concurrent calls together are limited to the default number of workers;
+        pages are rendered in place when no workers are free or the document has fewer than MIN_PARALLEL_PAGES.
+
+        Args:
+            pdfbytes (bytes): The PDF file data in bytes.
+            DPI (int, optional): The dots per inch (resolution) for image conversion. Defaults to 96.
+            num_workers (int | None, optional): The maximum number of worker processes. Defaults to the number
+                of CPUs available to this process, at most 4.
+            digest (bytes | None, optional): The precomputed content digest of pdfbytes. Defaults to None.
+
+        Yields:
+            Image: An image of a PDF page, in page order.
+        """
+        if num_workers is None:
+            num_workers = _default_workers()
+
+        doc = pdf_cache.acquire_document(pdfbytes, digest)
+        doc_lock = pdf_cache.document_lock(doc)
+        try:
+            with doc_lock:
+                n_pages = len(doc)
+            if n_pages < MIN_PARALLEL_PAGES:
+                num_workers = 0
+            else:
+                num_workers = _acquire_render_slots(min(num_workers, n_pages))
+            if num_workers <= 1:
+                # not worth spawning processes, or other requests use all workers: render in place
+                _release_render_slots(num_workers)
+                for i in range(n_pages):
+                    with doc_lock:
+                        pixmap = _rgb_pixmap(doc[i], DPI)
+                    yield _rgb_image(pixmap.samples_mv, pixmap.w, pixmap.h, pixmap.stride)
+                return
+        finally:
+            pdf_cache.release_document(doc)
+
+        try:
+            with ProcessPoolExecutor(
+                max_workers=num_workers,
+                mp_context=_mp_context,
+                initializer=_init_render_worker,
+                initargs=(pdfbytes,),
+            ) as executor:
+                # executor.map would queue every rendered page in memory when the consumer is slower than the
+                # workers; keep only a window of pages in flight so peak memory does not grow with page count
+                page_indices = iter(range(n_pages))
+                pending = deque(
+                    executor.submit(_render_page, i, DPI) for i in islice(page_indices, 2 * num_workers)
+                )
+                while pending:
+                    _, samples, w, h, stride = pending.popleft().result()
+                    for i in islice(page_indices, 1):
+                        pending.append(executor.submit(_render_page, i, DPI))
+                    image = _rgb_image(samples, w, h, stride)
+                    del samples  # the image holds its own copy of the pixels
+                    yield image
+        finally:
+            _release_render_slots(num_workers)
 
     def extract_figures(self, figure_bboxes):
         """
@@ -43,16 +315,17 @@ class PDFService:
         """
         results = {}
         for k, v in figure_bboxes.items():
-            page_image = self.page_to_image(self.doc[k])
-            figures = []
-            for pair in v:
-                figure = PDFService.pad_border(page_image.crop(pair[0]))
-                if pair[1]:  # optional caption
-                    caption = PDFService.pad_border(page_image.crop(pair[1]))
-                else:
-                    caption = None
-                figures.append([figure, caption])
-            results[k] = figures
+            figure_boxes = [pair[0] for pair in v]
+            caption_boxes = [pair[1] for pair in v]  # captions are optional
+            with self._doc_lock:
+                page = self.doc[k]
+                figures = [self.crop_page_region(page, bbox) for bbox in figure_boxes]
+                captions = [self.crop_page_region(page, bbox) if bbox else None for bbox in caption_boxes]
+                del page  # drop the page before releasing the lock
+            results[k] = [
+                [PDFService.pad_border(figure), PDFService.pad_border(caption) if caption is not None else None]
+                for figure, caption in zip(figures, captions)
+            ]
 
         return results
 
@@ -64,23 +337,31 @@ class PDFService:
             redaction_bboxes (dict): Bounding boxes for redaction.
             figure_bboxes (dict): Bounding boxes for figures and captions.
         """
-        delete_pages = []
-        for k, v in redaction_bboxes.items():
-            page = self.doc[k]
-            PDFService.redact_page(v, page, self.DPI)
-            if PDFService.is_blank_page(page):
-                delete_pages.append(k)
+        if not redaction_bboxes and not figure_bboxes:
+            return  # nothing to redact, keep the document unmodified
+
+        self.own_doc()
+        self._docbytes = None
+        self._redacted = True
 
+        # merge bboxes per page, so redactions are applied only once per page
+        page_bboxes = defaultdict(list)
+        for k, v in redaction_bboxes.items():
+            page_bboxes[k].extend(v)
         for k, v in figure_bboxes.items():
+            page_bboxes[k].extend(item for pair in v for item in pair if item)
+
+        delete_pages = []
+        for k, bboxes in page_bboxes.items():
+            if not bboxes:
+                continue  # e.g. a page listed with an empty list, no need to rewrite its content
             page = self.doc[k]
-            flattened = [item for pair in v for item in pair if item]
-            PDFService.redact_page(flattened, page, self.DPI)
+            self.redact_page(bboxes, page)
             if PDFService.is_blank_page(page):
                 delete_pages.append(k)
 
         if delete_pages:
             self.doc.delete_pages(delete_pages)
-        self.reduce_pdf_size()
 
     def delete_pages(
             self,
@@ -96,57 +377,124 @@ class PDFService:
             del_page_end (int | None): The ending page index for deletion.
             del_pages_list (list[int] | None): Specific page indices to delete.
         """
+        with self._doc_lock:
+            total_pages = len(self.doc)
         pages_to_delete = PDFService.selected_pages(
-            len(self.doc),
+            total_pages,
             start_page=del_page_start,
             end_page=del_page_end,
             pages_list=del_pages_list
         )
         if pages_to_delete:
+            self.own_doc()
+            self._docbytes = None
             self.doc.delete_pages(pages_to_delete)
-            self.reduce_pdf_size()
 
-    def page_to_image(self, page: Page) -> Image.Image:
+    def own_doc(self):
+        """
+        Replace the cached, shared Document with a private copy before it gets modified.
+        """
+        if self._release_shared_doc.alive:
+            self._release_shared_doc()
+            self.doc = PDFService.bytes_to_doc(self._pdfbytes)
+            self._doc_lock = threading.Lock()  # no longer shared, uncontended from now on
+
+    def redact_page(self, bboxes: list[list[int]], page: Page):
+        """
+        Redact regions of a PDF page based on bounding boxes.
+
+        Args:
+            bboxes (list[list[int]]): The bounding boxes to redact, in pixel coordinates at self.DPI.
+            page (Page): The PDF page to redact.
+        """
+        # need to convert bboxes to coords used by pymupdf when doing redaction
+        s = self._points_per_pixel
+        for x0, y0, x1, y1 in bboxes:
+            page.add_redact_annot(_Rect(x0 * s, y0 * s, x1 * s, y1 * s))
+        page.apply_redactions(2, 2, 0)
+
+    def page_to_image(self, page: Page, DPI: int | None = None) -> Image.Image:
         """
         Convert a single PDF page to an image.
 
         Args:
             page (Page): The PDF page to convert.
+            DPI (int | None, optional): The resolution for this call only. Defaults to self.DPI.
 
         Returns:
             Image.Image: The converted image.
         """
-        pixmap = page.get_pixmap(dpi=self.DPI)
-        return Image.frombytes('RGB', [pixmap.w, pixmap.h], pixmap.samples_mv)
+        pixmap = _rgb_pixmap(page, DPI or self.DPI)
+        return _rgb_image(pixmap.samples_mv, pixmap.w, pixmap.h, pixmap.stride)
+
+    def crop_page_region(self, page: Page, bbox: list[int]) -> Image.Image:
+        """
+        Render only a region of a PDF page to an image, without rendering the full page.
+
+        Args:
+            page (Page): The PDF page to render from.
+            bbox (list[int]): The region to render, in pixel coordinates at self.DPI.
+
+        Returns:
+            Image.Image: The image of the region.
+        """
+        s = self._points_per_pixel
+        clip = _Rect(*(c * s for c in bbox))
+        pixmap = _rgb_pixmap(page, self.DPI, clip)
+        return _rgb_image(pixmap.samples_mv, pixmap.w, pixmap.h, pixmap.stride)
 
     def reduce_pdf_size(self):
         """
-        Reduce the size of the PDF file after processing.
+        Reduce the size of the PDF document in memory after processing.
+
+        Not needed before `save`, which compacts the document while writing it.
         """
+        self.own_doc()
         docbytes = PDFService.doc_to_bytes(self.doc)
         self.doc = PDFService.bytes_to_doc(docbytes)
+        self._docbytes = docbytes
+
+    def finalize(self):
+        """
+        Compact the PDF document in memory once after a series of modifications.
+
+        Only needed when the document is processed further in memory; `save` compacts while writing.
+        """
+        if self._docbytes is None:
+            self.reduce_pdf_size()
 
     def save(self, output_filepath):
         """
-        Save the PDF document to a specified file path.
+        Save the PDF document to a specified file path, compacting it in the same pass.
+
+        An unmodified document is written as the original PDF data and a document compacted by `finalize`
+        as the compacted data, without encoding it again. A document that only had pages deleted
+        is written with lighter garbage collection.
 
         Args:
             output_filepath (str): The file path to save the updated PDF.
         """
-        self.doc.save(output_filepath)
+        docbytes = self._docbytes
+        if docbytes is None:
+            save_options = PDF_SAVE_OPTIONS if self._redacted else PAGE_DELETION_SAVE_OPTIONS
+            docbytes = PDFService.doc_to_bytes(self.doc, save_options)
+        # BufferedWriter passes the whole buffer through to the OS, looping over short writes
+        with open(output_filepath, 'wb') as f:
+            f.write(docbytes)
 
     @staticmethod
-    def doc_to_bytes(doc: Document) -> bytes:
+    def doc_to_bytes(doc: Document, save_options: dict = PDF_SAVE_OPTIONS) -> bytes:
         """
         Convert a PDF Document to bytes.
 
         Args:
             doc (Document): The PDF document to convert.
+            save_options (dict, optional): pymupdf options for writing the PDF. Defaults to PDF_SAVE_OPTIONS.
 
         Returns:
             bytes: The PDF data in bytes.
         """
-        return doc.tobytes(garbage=3, deflate=True, use_objstms=1)
+        return doc.tobytes(**save_options)
 
     @staticmethod
     def bytes_to_doc(pdfbytes: bytes) -> Document:
@@ -159,7 +507,19 @@ class PDFService:
         Returns:
             Document: The Document object representing the PDF.
         """
-        return pymupdf.open('pdf', pdfbytes)
+        return _open('pdf', pdfbytes)
+
+    @staticmethod
+    def save_image(image: Image.Image, output_filepath: str, image_format: str = 'png'):
+        """
+        Save an image to a specified file path using fast encoder settings.
+
+        Args:
+            image (Image.Image): The image to save.
+            output_filepath (str): The file path to save the image.
+            image_format (str, optional): One of the keys of IMAGE_SAVE_OPTIONS. Defaults to 'png'.
+        """
+        image.save(output_filepath, **IMAGE_SAVE_OPTIONS[image_format])
 
     @staticmethod
     def pad_border(image: Image.Image, border_width=10, border_color=(255, 255, 255)):
@@ -174,26 +534,13 @@ class PDFService:
         Returns:
             Image.Image: The padded image.
         """
-        return ImageOps.expand(image, border=border_width, fill=border_color)
-
-    @staticmethod
-    def redact_page(bboxes: list[list[int]], page: Page, DPI: int):
-        """
-        Redact regions of a PDF page based on bounding boxes.
-
-        Args:
-            bboxes (list[list[int]]): The bounding boxes to redact.
-            page (Page): The PDF page to redact.
-            DPI (int): The resolution for converting bounding boxes.
-        """
-        # need to convert bboxes to coords used by pymupdf when doing redaction
-        # pymupdf uses DPI 72 for redaction
-        arr = np.array(bboxes) * 72 / DPI
-        arr = arr.astype(int).tolist()
-
-        for bbox in arr:
-            page.add_redact_annot(bbox)
-        page.apply_redactions(2, 2, 0)
+        padded = Image.new(
+            image.mode,
+            (image.width + 2 * border_width, image.height + 2 * border_width),
+            border_color
+        )
+        padded.paste(image, (border_width, border_width))
+        return padded
 
     @staticmethod
     def is_blank_page(page: Page) -> bool:
@@ -206,11 +553,13 @@ class PDFService:
         Returns:
             bool: True if the page is blank, False otherwise.
         """
-        text = page.get_text().strip()
-        if not text:
-            return True
-        else:
-            return False
+        # blocks yield far fewer tuples than words; stop at the first block with any visible text.
+        # image blocks are not extracted without TEXT_PRESERVE_IMAGES
+        flags = pymupdf.TEXT_MEDIABOX_CLIP | pymupdf.TEXT_INHIBIT_SPACES
+        for block in page.get_text('blocks', flags=flags):
+            if block[4] and not block[4].isspace():
+                return False
+        return True
 
     @staticmethod
     def selected_pages(
@@ -234,7 +583,8 @@ class PDFService:
         Raises:
             ValueError: If the page selection is invalid.
         """
-        pages_to_process = set()
+        # one flag per page, the selected indices come out already sorted and deduplicated
+        pages_to_process = bytearray(total_pages)
 
         if start_page or end_page:
             if start_page:
@@ -255,12 +605,12 @@ class PDFService:
             if start_page or end_page:
                 start_page = start_page if start_page else 0
                 end_page = end_page if end_page else total_pages - 1
-                pages_to_process.update(
-                    list(range(start_page, end_page+1))
-                )
+                selected = range(start_page, end_page+1)
+                pages_to_process[start_page:end_page+1] = b'\x01' * len(selected)
 
         if pages_list:
-            pages_to_process.update(pages_list)
+            for page in pages_list:
+                if 0 <= page < total_pages:
+                    pages_to_process[page] = 1
 
-        pages_to_process = list(filter(lambda x: x < total_pages, pages_to_process))
-        return sorted(pages_to_process)
+        return list(compress(range(total_pages), pages_to_process))
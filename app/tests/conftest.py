@@ -0,0 +1,7 @@
+import pytest
+
+
+@pytest.fixture(scope='module')
+def pdfbytes():
+    with open('app/tests/test_data/test_document.pdf', 'rb') as f:
+        return f.read()
@@ -0,0 +1,115 @@
+import gc
+import pymupdf
+import pytest
+
+from app.services import pdf_cache
+from app.services.pdf_service_v1 import PDFService
+
+
+@pytest.fixture(scope='module')
+def other_pdfbytes():
+    with pymupdf.open() as doc:
+        doc.new_page()
+        return doc.tobytes()
+
+
+@pytest.fixture(autouse=True)
+def empty_cache():
+    pdf_cache.clear()
+    yield
+    pdf_cache.clear()
+
+
+def borrows(doc):
+    return pdf_cache._borrows[id(doc)]
+
+
+def test_hit_bumps_borrow_count(pdfbytes):
+    """
+    Test a cache hit returns the same document and counts the new borrower
+    """
+    doc = pdf_cache.acquire_document(pdfbytes)
+    assert borrows(doc) == 1
+
+    assert pdf_cache.acquire_document(pdfbytes) is doc
+    assert borrows(doc) == 2
+
+    pdf_cache.release_document(doc)
+    pdf_cache.release_document(doc)
+    assert borrows(doc) == 0
+    assert not doc.is_closed  # still cached
+
+
+def test_evicted_doc_closed_on_last_release(pdfbytes, other_pdfbytes, monkeypatch):
+    """
+    Test an evicted document that is still borrowed is closed only when its last borrower releases it
+    """
+    monkeypatch.setattr(pdf_cache, 'MAX_CACHED_DOCS', 1)
+    doc = pdf_cache.acquire_document(pdfbytes)
+    pdf_cache.acquire_document(pdfbytes)
+
+    other = pdf_cache.acquire_document(other_pdfbytes)  # evicts doc
+    assert not doc.is_closed
+
+    pdf_cache.release_document(doc)
+    assert not doc.is_closed
+    pdf_cache.release_document(doc)
+    assert doc.is_closed
+
+    pdf_cache.release_document(other)
+
+
+def test_clear_defers_closing_borrowed_docs(pdfbytes):
+    """
+    Test clearing the cache does not close a document that is still borrowed
+    """
+    doc = pdf_cache.acquire_document(pdfbytes)
+    pdf_cache.clear()
+    assert not doc.is_closed
+    assert len(doc) == 2
+
+    pdf_cache.release_document(doc)
+    assert doc.is_closed
+
+
+def test_own_doc_releases_shared_doc_once(pdfbytes):
+    """
+    Test PDFService.own_doc releases the shared document exactly once
+    """
+    pdf_service = PDFService(pdfbytes)
+    shared = pdf_service.doc
+    assert borrows(shared) == 1
+
+    pdf_service.own_doc()
+    assert pdf_service.doc is not shared
+    assert borrows(shared) == 0
+
+    pdf_service.own_doc()
+    del pdf_service
+    gc.collect()
+    assert borrows(shared) == 0
+    assert not shared.is_closed
+
+
+def test_services_do_not_close_each_others_doc(pdfbytes):
+    """
+    Test two PDFService instances on the same data share the document without closing it for each other
+    """
+    first = PDFService(pdfbytes)
+    second = PDFService(pdfbytes)
+    shared = second.doc
+    assert first.doc is shared
+    assert borrows(shared) == 2
+
+    first.own_doc()
+    del first
+    gc.collect()
+    assert borrows(shared) == 1
+
+    pdf_cache.clear()  # evicted while second still uses it
+    assert not shared.is_closed
+    assert len(second.doc) == 2
+
+    del second
+    gc.collect()
+    assert shared.is_closed
@@ -1,11 +1,19 @@
+import asyncio
+import os
+import time
 import tempfile
 import json
+import threading
+from concurrent.futures import ProcessPoolExecutor
 import pytest
+import pymupdf
 from fastapi import FastAPI, status
 from fastapi.testclient import TestClient
 
 from app.core.config import settings
 from app.api.endpoints import heartbeat, pdf_v1
+from app.services import pdf_service_v1
+from app.services.pdf_service_v1 import PAGE_DELETION_SAVE_OPTIONS, PDF_SAVE_OPTIONS, PDFService
 
 
 @pytest.fixture(scope='module')
@@ -50,6 +58,25 @@ def test_pdf_to_images_valid(client: TestClient, temp_dir):
         assert path.endswith('.png')
 
 
+@pytest.mark.parametrize('fmt', ['jpeg', 'webp'])
+def test_pdf_to_images_format(client: TestClient, temp_dir, fmt):
+    """
+    Test /pdf/images endpoint with other output formats
+    """
+    test_file_path = 'app/tests/test_data/test_document.pdf'
+    with open(test_file_path, 'rb') as f:
+        files = {'file': f}
+        response = client.post('/pdf/images', files=files, params={'fmt': fmt})
+
+    assert response.status_code == status.HTTP_200_OK
+    image_paths = response.json()
+    assert len(image_paths) == 2
+    for path in image_paths:
+        assert path.startswith(settings.TEMPFILE_ROOT_DIR)
+        assert path.endswith(f'.{fmt}')
+        assert os.path.exists(path)
+
+
 def test_pdf_to_images_invalid_file_type(client: TestClient, temp_dir):
     """
     Test /pdf/images endpoint with invalid file type
@@ -64,6 +91,32 @@ def test_pdf_to_images_invalid_file_type(client: TestClient, temp_dir):
     assert 'Invalid file type. Only PDF file allowed.' == error_response['detail']
 
 
+def test_pdf_to_images_octet_stream(client: TestClient, temp_dir):
+    """
+    Test /pdf/images endpoint accepts a PDF file sent with a generic content type
+    """
+    test_file_path = 'app/tests/test_data/test_document.pdf'
+    with open(test_file_path, 'rb') as f:
+        files = {'file': ('test_document.pdf', f, 'application/octet-stream')}
+        response = client.post('/pdf/images', files=files)
+
+    assert response.status_code == status.HTTP_200_OK
+    assert len(response.json()) == 2
+
+
+def test_pdf_to_images_fake_pdf(client: TestClient, temp_dir):
+    """
+    Test /pdf/images endpoint rejects a non-PDF file sent with the PDF content type
+    """
+    test_file_path = 'app/tests/test_data/gemini_generated_image.jpeg'
+    with open(test_file_path, 'rb') as f:
+        files = {'file': ('image.pdf', f, 'application/pdf')}
+        response = client.post('/pdf/images', files=files)
+
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+    assert 'Invalid file type. Only PDF file allowed.' == response.json()['detail']
+
+
 def test_pdf_to_images_missing_file(client: TestClient):
     """
     Test /pdf/images endpoint without providing any file
@@ -117,6 +170,34 @@ def test_extract_figures_valid(client: TestClient, temp_dir):
                     assert fig.endswith('.png')
 
 
+def test_extract_figures_array_layout(client: TestClient, temp_dir):
+    """
+    Test /pdf/figures endpoint with bboxes given as arrays of [page, bboxes] pairs
+    """
+    test_file_path = 'app/tests/test_data/test_document.pdf'
+    redaction_bboxes = [
+        [0, [[0, 0, 816, 66], [0, 990, 816, 1056]]],
+        ["1", [[0, 0, 816, 66]]],  # page numbers given as strings are accepted too
+    ]
+    figure_bboxes = [
+        ["1", [[[171, 64, 643, 370], [264, 368, 548, 404]]]]
+    ]
+    with open(test_file_path, 'rb') as f:
+        files = {'file': f}
+        data = {
+            "redaction_bboxes": json.dumps(redaction_bboxes),
+            "figure_bboxes": json.dumps(figure_bboxes),
+        }
+        response = client.post('/pdf/figures', files=files, data=data)
+
+    assert response.status_code == status.HTTP_200_OK
+    response_data = response.json()
+    assert list(response_data['figures']) == ['1']
+    figure, caption = response_data['figures']['1'][0]
+    assert os.path.exists(figure)
+    assert os.path.exists(caption)
+
+
 def test_extract_figures_missing_required_data(client: TestClient):
     """
     Test /pdf/figures endpoint without required form data
@@ -130,3 +211,251 @@ def test_extract_figures_missing_required_data(client: TestClient):
     assert 'detail' in error_response
     assert 'redaction_bboxes' in str(error_response['detail'])
     assert 'figure_bboxes' in str(error_response['detail'])
+
+
+def test_get_tempfiles(client: TestClient, temp_dir):
+    """
+    Test /pdf/tempfiles endpoint lists only files older than the retention time
+    """
+    old_file = os.path.join(temp_dir, 'old.png')
+    new_file = os.path.join(temp_dir, 'new.png')
+    for path in (old_file, new_file):
+        with open(path, 'wb'):
+            pass
+    expired = time.time() - settings.FILE_RETENTION_TIME - 60
+    os.utime(old_file, (expired, expired))
+
+    response = client.get('/pdf/tempfiles')
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json() == [old_file]
+
+
+def test_list_tempfiles_cache(temp_dir):
+    """
+    Test a temp file listing is reused within a quarter retention time and dropped by cleanup_tempfiles
+    """
+    expired = time.time() - settings.FILE_RETENTION_TIME - 60
+    old_files = [os.path.join(temp_dir, name) for name in ('old1.png', 'old2.png')]
+
+    def create_expired_file(path):
+        with open(path, 'wb'):
+            pass
+        os.utime(path, (expired, expired))
+
+    create_expired_file(old_files[0])
+    assert pdf_v1.list_tempfiles(use_cache=True) == old_files[:1]
+
+    create_expired_file(old_files[1])
+    assert pdf_v1.list_tempfiles(use_cache=True) == old_files[:1]  # reused listing
+    assert sorted(pdf_v1.list_tempfiles()) == old_files
+
+    asyncio.run(pdf_v1.cleanup_tempfiles())
+    assert pdf_v1._tempfiles_listing is None
+    assert pdf_v1.list_tempfiles(use_cache=True) == []
+    assert not any(os.path.exists(path) for path in old_files)
+
+def test_remove_files_skips_missing_files(temp_dir):
+    """
+    Test remove_files ignores files already removed by a concurrent cleanup
+    """
+    existing_file = os.path.join(temp_dir, 'existing.png')
+    with open(existing_file, 'wb'):
+        pass
+    missing_file = os.path.join(temp_dir, 'missing.png')
+
+    asyncio.run(pdf_v1.remove_files([existing_file, missing_file]))
+    assert not os.path.exists(existing_file)
+
+
+@pytest.mark.parametrize('selection, expected', [
+    ({'start_page': 3}, [3, 4, 5, 6, 7, 8, 9]),
+    ({'end_page': 4}, [0, 1, 2, 3, 4]),
+    ({'end_page': 20}, [0, 1, 2, 3, 4, 5, 6, 7, 8, 9]),
+    ({'start_page': -3, 'end_page': -1}, [7, 8, 9]),
+    ({'start_page': 5, 'end_page': 2}, []),
+    ({'pages_list': [2, 2, 15]}, [2]),
+    ({'pages_list': [-1, 3]}, [3]),  # negative entries are ignored
+    ({'start_page': 8, 'pages_list': [1, 8]}, [1, 8, 9]),
+    ({}, []),
+])
+def test_selected_pages(selection, expected):
+    """
+    Test PDFService.selected_pages with page ranges and page lists
+    """
+    assert PDFService.selected_pages(10, **selection) == expected
+
+
+@pytest.mark.parametrize('selection', [{'start_page': 10}, {'end_page': -11}])
+def test_selected_pages_invalid(selection):
+    """
+    Test PDFService.selected_pages rejects ranges outside of the document
+    """
+    with pytest.raises(ValueError):
+        PDFService.selected_pages(10, **selection)
+
+
+def test_save_unmodified(pdfbytes, tmp_path):
+    """
+    Test PDFService.save writes an unmodified document as the original PDF data
+    """
+    docpath = str(tmp_path / 'doc.pdf')
+    PDFService(pdfbytes).save(docpath)
+
+    with open(docpath, 'rb') as f:
+        assert f.read() == pdfbytes
+    with pymupdf.open(docpath) as doc:
+        assert len(doc) == 2
+
+
+def test_save_after_finalize(pdfbytes, tmp_path, monkeypatch):
+    """
+    Test PDFService.save writes a finalized document as the compacted data, without encoding it again
+    """
+    pdf_service = PDFService(pdfbytes)
+    pdf_service.delete_pages(del_pages_list=[1])
+    pdf_service.finalize()
+    compacted = pdf_service._docbytes
+
+    def doc_to_bytes(*args, **kwargs):
+        raise AssertionError('finalized document encoded again')
+
+    monkeypatch.setattr(PDFService, 'doc_to_bytes', staticmethod(doc_to_bytes))
+    docpath = str(tmp_path / 'doc.pdf')
+    pdf_service.save(docpath)
+
+    with open(docpath, 'rb') as f:
+        assert f.read() == compacted
+    with pymupdf.open(docpath) as doc:
+        assert len(doc) == 1
+
+
+@pytest.mark.parametrize('redact, expected_options', [
+    (False, PAGE_DELETION_SAVE_OPTIONS),
+    (True, PDF_SAVE_OPTIONS),
+])
+def test_save_modified(pdfbytes, tmp_path, monkeypatch, redact, expected_options):
+    """
+    Test PDFService.save uses lighter garbage collection for a document that only had pages deleted
+    """
+    save_options = []
+    doc_to_bytes = PDFService.doc_to_bytes
+
+    def recording_doc_to_bytes(doc, options=PDF_SAVE_OPTIONS):
+        save_options.append(options)
+        return doc_to_bytes(doc, options)
+
+    monkeypatch.setattr(PDFService, 'doc_to_bytes', staticmethod(recording_doc_to_bytes))
+    pdf_service = PDFService(pdfbytes)
+    if redact:
+        pdf_service.redact_doc({0: [[0, 0, 816, 66]]}, {})
+    pdf_service.delete_pages(del_pages_list=[1])
+    docpath = str(tmp_path / 'doc.pdf')
+    pdf_service.save(docpath)
+
+    assert save_options == [expected_options]
+    with pymupdf.open(docpath) as doc:
+        assert len(doc) == 1
+
+
+def test_redact_doc_once_per_page(pdfbytes, monkeypatch):
+    """
+    Test PDFService.redact_doc applies redactions once per page and leaves pages listed without bboxes as they are
+    """
+    with pymupdf.open('pdf', pdfbytes) as doc:
+        doc.new_page()  # blank page 2
+        pdfbytes_with_blank_page = doc.tobytes()
+
+    redacted_pages = []
+    apply_redactions = pymupdf.Page.apply_redactions
+
+    def counting_apply_redactions(page, *args, **kwargs):
+        redacted_pages.append(page.number)
+        return apply_redactions(page, *args, **kwargs)
+
+    monkeypatch.setattr(pymupdf.Page, 'apply_redactions', counting_apply_redactions)
+    pdf_service = PDFService(pdfbytes_with_blank_page)
+    pdf_service.redact_doc(
+        {0: [[0, 0, 816, 66]], 2: []},
+        {0: [[[171, 64, 643, 370], [264, 368, 548, 404]]]},
+    )
+
+    assert redacted_pages == [0]  # redaction and figure bboxes of page 0 are merged
+    assert len(pdf_service.doc) == 3  # the blank page listed with [] is not deleted
+
+
+@pytest.fixture(scope='module')
+def long_pdfbytes(pdfbytes):
+    with pymupdf.open('pdf', pdfbytes) as src, pymupdf.open() as doc:
+        for _ in range(5):
+            doc.insert_pdf(src)
+        return doc.tobytes()  # 10 pages, above MIN_PARALLEL_PAGES
+
+
+@pytest.fixture
+def render_executors(monkeypatch):
+    """
+    Allow 2 render workers and record the process pools started for rendering, along with the largest number
+    of pages submitted ahead of the results retrieved.
+    """
+    executors = []
+
+    class RecordingExecutor(ProcessPoolExecutor):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.submitted = self.retrieved = self.max_ahead = 0
+            executors.append(self)
+
+        def submit(self, *args, **kwargs):
+            self.submitted += 1
+            self.max_ahead = max(self.max_ahead, self.submitted - self.retrieved)
+            future = super().submit(*args, **kwargs)
+            result = future.result
+
+            def counting_result(*args, **kwargs):
+                self.retrieved += 1
+                return result(*args, **kwargs)
+
+            future.result = counting_result
+            return future
+
+    monkeypatch.setattr(pdf_service_v1, '_render_slots', threading.BoundedSemaphore(2))
+    monkeypatch.setattr(pdf_service_v1, 'ProcessPoolExecutor', RecordingExecutor)
+    return executors
+
+
+def assert_render_slots_free(n):
+    taken = pdf_service_v1._acquire_render_slots(n + 1)
+    pdf_service_v1._release_render_slots(taken)
+    assert taken == n
+
+
+def test_doc_to_images_parallel(long_pdfbytes, render_executors):
+    """
+    Test PDFService.doc_to_images_parallel renders pages in worker processes, in page order
+    """
+    images = list(PDFService.doc_to_images_parallel(long_pdfbytes, num_workers=2))
+
+    assert len(render_executors) == 1
+    assert render_executors[0]._max_workers == 2
+    assert render_executors[0].max_ahead == 2 * 2  # the window of pages in flight is filled, never exceeded
+    assert_render_slots_free(2)
+
+    pdf_service = PDFService(long_pdfbytes)
+    expected = [pdf_service.page_to_image(page) for page in pdf_service.doc]
+    assert len(images) == len(expected) == 10
+    for image, expected_image in zip(images, expected):
+        assert image.size == expected_image.size
+        assert image.tobytes() == expected_image.tobytes()
+
+
+def test_doc_to_images_parallel_closed_early(long_pdfbytes, render_executors):
+    """
+    Test PDFService.doc_to_images_parallel gives back its render worker slots when closed before the last page
+    """
+    images = PDFService.doc_to_images_parallel(long_pdfbytes, num_workers=2)
+    next(images)
+    assert_render_slots_free(0)
+
+    images.close()
+    assert len(render_executors) == 1
+    assert_render_slots_free(2)